@@ -0,0 +1,21 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+
+def write_csv(df: pd.DataFrame, dest, include_header: bool = True) -> None:
+    """
+    Writes df as UTF-8 CSV using pyarrow's CSV writer (no index column).
+
+    dest is a path or a file opened in binary mode, so several frames can be
+    appended to one file (pass include_header=False after the first one).
+    Falls back to DataFrame.to_csv for columns pyarrow cannot type, such as
+    a mix of numbers and strings straight from Gemini.
+    """
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        df.to_csv(dest, header=include_header, index=False, encoding="utf-8")
+        return
+
+    pacsv.write_csv(table, dest, write_options=pacsv.WriteOptions(include_header=include_header))
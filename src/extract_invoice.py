@@ -1,29 +1,114 @@
 import os
+import io
 import json
+import asyncio
+import tempfile
+import functools
+from concurrent.futures import Executor, ProcessPoolExecutor
+import orjson
 import pandas as pd
 from typing import List, Dict, Any
+from typing_extensions import TypedDict
 
 from PIL import Image
 from pdf2image import convert_from_path
 import google.generativeai as genai
 
+from src import llm_cache
+from src.csv_writer import write_csv
+
 # -------------------------------------------------------------------
-# Load config
+# Load config (lazily, once per process)
 # -------------------------------------------------------------------
-with open("config/config.json", "r", encoding="utf-8") as f:
-    config = json.load(f)
-
-GEMINI_API_KEY = config.get("gemini_api_key")
-POPPLER_PATH = config.get("poppler_path")  # e.g. "C:/Users/DELL/Downloads/.../bin"
+@functools.lru_cache(maxsize=1)
+def _get_config() -> Dict[str, Any]:
+    with open("config/config.json", "r", encoding="utf-8") as f:
+        return json.load(f)
 
-if not GEMINI_API_KEY:
-    raise ValueError("Missing 'gemini_api_key' in config/config.json")
 
 # -------------------------------------------------------------------
-# Configure Gemini
+# Configure Gemini (lazily, on first use)
 # -------------------------------------------------------------------
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
+@functools.lru_cache(maxsize=1)
+def _get_model() -> genai.GenerativeModel:
+    api_key = _get_config().get("gemini_api_key")
+    if not api_key:
+        raise ValueError("Missing 'gemini_api_key' in config/config.json")
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel("gemini-1.5-flash")
+
+# Max number of Gemini requests in flight at once (keeps us under the QPM limit)
+GEMINI_CONCURRENCY = 20
+
+EXPECTED_COLUMNS = [
+    "item_description",
+    "quantity",
+    "unit_price",
+    "total_non_vat_value",
+    "vat_amount",
+    "currency",
+]
+
+# Images are shrunk to fit this box and sent as JPEG: invoice text stays
+# readable while the upload is a fraction of a full-resolution page
+MAX_IMAGE_SIZE = (1600, 1600)
+JPEG_QUALITY = 85
+
+MONEY_COLUMNS = ["unit_price", "total_non_vat_value", "vat_amount"]
+
+# dtypes used when reading extracted_invoices.csv back in
+# (same as extract_line_items() produces, see _downcast_dtypes)
+EXTRACTED_DTYPES = {
+    "item_description": str,
+    "quantity": "float32",
+    **{col: "float64" for col in MONEY_COLUMNS},
+    "currency": "category",
+    "invoice_file": str,
+}
+
+# Response schema: Gemini returns a strict JSON array of these (no ``` fences)
+class LineItem(TypedDict):
+    item_description: str
+    quantity: float
+    unit_price: float
+    total_non_vat_value: float
+    vat_amount: float
+    currency: str
+
+LINE_ITEMS_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=list[LineItem],
+)
+
+INVOICE_PROMPT = """
+You are an expert in reading tax invoices.
+
+Analyze this tax invoice and extract EACH line item as a JSON object
+with the following keys:
+
+- item_description (string)
+- quantity (number)
+- unit_price (number, excluding VAT)
+- total_non_vat_value (number)
+- vat_amount (number)
+- currency (string)
+
+Return ONLY a valid JSON array of objects.
+Example:
+[
+  {
+    "item_description": "Laptop Model X",
+    "quantity": 1,
+    "unit_price": 900.0,
+    "total_non_vat_value": 900.0,
+    "vat_amount": 100.0,
+    "currency": "USD"
+  }
+]
+
+No explanations, no comments, no extra fields.
+"""
 
 
 # -------------------------------------------------------------------
@@ -33,22 +118,135 @@ def parse_json_from_response(text: str) -> Any:
     """
     Takes the raw response.text from Gemini and tries to extract a valid JSON value.
     Handles cases where the model wraps output in ```json ... ``` fences.
+    Raises json.JSONDecodeError (orjson's error subclasses it) on invalid JSON.
     """
     text = text.strip()
 
-    # If fenced in ```json ... ``` or ```...``` remove the fences
-    if text.startswith("```"):
-        lines = text.splitlines()
-        # Drop first line (``` or ```json)
-        if lines and lines[0].strip().startswith("```"):
-            lines = lines[1:]
-        # Drop last line if it's ```
-        if lines and lines[-1].strip().startswith("```"):
-            lines = lines[:-1]
-        text = "\n".join(lines).strip()
+    # Fast path: unfenced JSON, which is what schema-constrained replies look like
+    if text[:1] != "`":
+        return orjson.loads(text)
+
+    # Fenced in ```json ... ``` or ```...```: remove the fences
+    lines = text.splitlines()
+    # Drop first line (``` or ```json)
+    if lines and lines[0].strip().startswith("```"):
+        lines = lines[1:]
+    # Drop last line if it's ```
+    if lines and lines[-1].strip().startswith("```"):
+        lines = lines[:-1]
+    text = "\n".join(lines).strip()
 
     # Now `text` should be pure JSON (array or object)
-    return json.loads(text)
+    return orjson.loads(text)
+
+
+# -------------------------------------------------------------------
+# Helper: load the first page of an invoice as a PIL image
+# -------------------------------------------------------------------
+def _load_invoice_image(invoice_path: str) -> Image.Image:
+    """
+    Converts a PDF (first page) or opens an image file for Gemini.
+    """
+    if invoice_path.lower().endswith(".pdf"):
+        print(f"[INFO] Converting PDF to image: {invoice_path}")
+        # Only the first page is sent to Gemini, so don't rasterize the rest
+        convert_kwargs = {
+            "dpi": 150,
+            "first_page": 1,
+            "last_page": 1,
+            "thread_count": os.cpu_count() or 1,
+        }
+        # Use poppler_path if provided in config, e.g. "C:/Users/DELL/Downloads/.../bin"
+        poppler_path = _get_config().get("poppler_path")
+        if poppler_path:
+            convert_kwargs["poppler_path"] = poppler_path
+
+        # Render pages to a temp folder instead of holding every page in memory
+        with tempfile.TemporaryDirectory() as output_folder:
+            images = convert_from_path(invoice_path, output_folder=output_folder, **convert_kwargs)
+
+            if not images:
+                raise ValueError("No pages found in PDF.")
+            img = images[0].copy()
+
+            # Release the page files so the temp folder can be removed
+            for page in images:
+                page.close()
+
+        return img
+
+    print(f"[INFO] Opening image file: {invoice_path}")
+    return Image.open(invoice_path)
+
+
+def _encode_invoice_image(invoice_path: str) -> Dict[str, Any]:
+    """
+    Loads the invoice image, downscales it to MAX_IMAGE_SIZE and encodes it
+    as an in-memory JPEG blob ready to pass to Gemini.
+    """
+    img = _load_invoice_image(invoice_path)
+    img.thumbnail(MAX_IMAGE_SIZE, Image.LANCZOS)
+
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buf.getvalue()}
+
+
+# -------------------------------------------------------------------
+# Helpers: Gemini response → line items → DataFrame
+# -------------------------------------------------------------------
+def _parse_line_items(response: Any, invoice_path: str) -> Any:
+    """
+    Parses the JSON payload out of a Gemini response.
+    Returns None if the response is empty.
+    """
+    if not hasattr(response, "text") or not response.text:
+        print(f"[WARN] Empty response from Gemini for: {invoice_path}")
+        return None
+
+    raw_text = response.text
+    try:
+        return parse_json_from_response(raw_text)
+    except json.JSONDecodeError as je:
+        print(f"[ERROR] JSON parsing failed for: {invoice_path}")
+        print(f"Raw response (first 500 chars):\n{raw_text[:500]}...")
+        raise je
+
+
+def _line_items_to_dataframe(line_items: Any, invoice_path: str) -> pd.DataFrame:
+    """
+    Converts parsed line items into a DataFrame with EXPECTED_COLUMNS
+    (in that order), or an empty DataFrame if there is nothing usable.
+    """
+    if isinstance(line_items, list) and line_items:
+        df = pd.DataFrame(line_items)
+
+        # Ensure expected columns exist (even if null)
+        for col in EXPECTED_COLUMNS:
+            if col not in df.columns:
+                df[col] = None
+
+        df = df[EXPECTED_COLUMNS]  # keep column order consistent
+        return _downcast_dtypes(df)
+
+    if line_items is not None:
+        print(f"[WARN] Parsed JSON is not a non-empty list for: {invoice_path}")
+    return pd.DataFrame()
+
+
+def _downcast_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Gives an invoice DataFrame compact, numeric dtypes (non-numbers -> NaN):
+    quantity -> float32, money columns -> float64, currency -> category.
+
+    Money stays float64: float32 only keeps ~7 significant digits, which is
+    not enough to compare large amounts against the matcher's 0.01 tolerance.
+    """
+    df["quantity"] = pd.to_numeric(df["quantity"], errors="coerce").astype("float32")
+    for col in MONEY_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors="coerce").astype("float64")
+    df["currency"] = df["currency"].astype("category")
+    return df
 
 
 # -------------------------------------------------------------------
@@ -57,6 +255,7 @@ def parse_json_from_response(text: str) -> Any:
 def extract_line_items(invoice_path: str) -> pd.DataFrame:
     """
     Extracts line items from a single invoice (PDF or image) using Gemini.
+    Results are cached by file content, so unchanged invoices skip Gemini.
 
     Returns:
         DataFrame with columns at least:
@@ -68,138 +267,152 @@ def extract_line_items(invoice_path: str) -> pd.DataFrame:
         - currency
     """
     try:
-        # 1) Convert invoice into an image
-        invoice_path_lower = invoice_path.lower()
-
-        if invoice_path_lower.endswith(".pdf"):
-            print(f"[INFO] Converting PDF to image: {invoice_path}")
-            # Use poppler_path if provided in config
-            if POPPLER_PATH:
-                images = convert_from_path(invoice_path, dpi=200, poppler_path=POPPLER_PATH)
-            else:
-                images = convert_from_path(invoice_path, dpi=200)
-
-            if not images:
-                raise ValueError("No pages found in PDF.")
-            img = images[0]  # first page only for now
+        cache_key = llm_cache.file_key(invoice_path, "lineitems")
+        line_items = llm_cache.get(cache_key)
+
+        if line_items is None:
+            image_blob = _encode_invoice_image(invoice_path)
+            response = _get_model().generate_content([INVOICE_PROMPT, image_blob],
+                                                     generation_config=LINE_ITEMS_CONFIG)
+            line_items = _parse_line_items(response, invoice_path)
+            if isinstance(line_items, list) and line_items:
+                llm_cache.put(cache_key, line_items)
         else:
-            print(f"[INFO] Opening image file: {invoice_path}")
-            img = Image.open(invoice_path)
-
-        # 2) Prompt for Gemini
-        prompt = """
-        You are an expert in reading tax invoices.
-
-        Analyze this tax invoice and extract EACH line item as a JSON object
-        with the following keys:
-
-        - item_description (string)
-        - quantity (number)
-        - unit_price (number, excluding VAT)
-        - total_non_vat_value (number)
-        - vat_amount (number)
-        - currency (string)
-
-        Return ONLY a valid JSON array of objects.
-        Example:
-        [
-          {
-            "item_description": "Laptop Model X",
-            "quantity": 1,
-            "unit_price": 900.0,
-            "total_non_vat_value": 900.0,
-            "vat_amount": 100.0,
-            "currency": "USD"
-          }
-        ]
-
-        No explanations, no comments, no extra fields.
-        """
-
-        # 3) Call Gemini with vision + instructions
-        response = model.generate_content([prompt, img])
-
-        if not hasattr(response, "text") or not response.text:
-            print(f"[WARN] Empty response from Gemini for: {invoice_path}")
-            return pd.DataFrame()
+            print(f"[INFO] Using cached line items for: {invoice_path}")
 
-        raw_text = response.text
-        # 4) Parse JSON safely
-        try:
-            line_items = parse_json_from_response(raw_text)
-        except json.JSONDecodeError as je:
-            print(f"[ERROR] JSON parsing failed for: {invoice_path}")
-            print(f"Raw response (first 500 chars):\n{raw_text[:500]}...")
-            raise je
-
-        # 5) Convert list of dicts → DataFrame
-        if isinstance(line_items, list) and line_items:
-            df = pd.DataFrame(line_items)
-
-            # Ensure expected columns exist (even if null)
-            expected_cols = [
-                "item_description",
-                "quantity",
-                "unit_price",
-                "total_non_vat_value",
-                "vat_amount",
-                "currency",
-            ]
-            for col in expected_cols:
-                if col not in df.columns:
-                    df[col] = None
-
-            return df[expected_cols]  # keep column order consistent
-
-        else:
-            print(f"[WARN] Parsed JSON is not a non-empty list for: {invoice_path}")
-            return pd.DataFrame()
+        return _line_items_to_dataframe(line_items, invoice_path)
 
     except Exception as e:
         print(f"[ERROR] Failed to process {invoice_path}: {e}")
         return pd.DataFrame()
 
 
+async def extract_line_items_async(invoice_path: str,
+                                   semaphore: asyncio.Semaphore,
+                                   executor: Executor | None = None) -> pd.DataFrame:
+    """
+    Async version of extract_line_items().
+
+    The semaphore caps how many invoices are in flight at once so a large
+    folder does not exceed Gemini rate limits. PDF conversion / image encoding
+    runs on `executor` (a process pool when called from process_invoices_async),
+    or in a worker thread if none is given, so it never blocks the event loop.
+    """
+    async with semaphore:
+        try:
+            cache_key = llm_cache.file_key(invoice_path, "lineitems")
+            line_items = llm_cache.get(cache_key)
+
+            if line_items is None:
+                loop = asyncio.get_running_loop()
+                image_blob = await loop.run_in_executor(executor, _encode_invoice_image, invoice_path)
+                response = await _get_model().generate_content_async(
+                    [INVOICE_PROMPT, image_blob],
+                    generation_config=LINE_ITEMS_CONFIG,
+                )
+                line_items = _parse_line_items(response, invoice_path)
+                if isinstance(line_items, list) and line_items:
+                    llm_cache.put(cache_key, line_items)
+            else:
+                print(f"[INFO] Using cached line items for: {invoice_path}")
+
+            return _line_items_to_dataframe(line_items, invoice_path)
+
+        except Exception as e:
+            print(f"[ERROR] Failed to process {invoice_path}: {e}")
+            return pd.DataFrame()
+
+
 # -------------------------------------------------------------------
 # Process all invoices in a folder & save combined output
 # -------------------------------------------------------------------
-def process_invoices(invoices_folder: str, data_folder: str) -> pd.DataFrame:
+async def _extract_named(file_name: str,
+                         full_path: str,
+                         semaphore: asyncio.Semaphore,
+                         executor: Executor) -> tuple[str, pd.DataFrame]:
     """
-    Process all PDF/image invoices in the given folder.
+    Wraps extract_line_items_async() so results can be consumed in
+    completion order and still be tied back to their file.
+    """
+    return file_name, await extract_line_items_async(full_path, semaphore, executor)
+
 
-    - Extracts line items for each invoice
+async def process_invoices_async(invoices_folder: str,
+                                 data_folder: str,
+                                 concurrency: int = GEMINI_CONCURRENCY) -> pd.DataFrame:
+    """
+    Process all PDF/image invoices in the given folder concurrently.
+
+    - Extracts line items for each invoice (up to `concurrency` Gemini calls at once,
+      PDF/image decoding on a process pool)
     - Adds 'invoice_file' column
-    - Saves combined data to data_folder/extracted_invoices.csv
+    - Appends each invoice to data_folder/extracted_invoices.csv as soon as it
+      finishes, so only one invoice's rows are held in memory at a time
 
     Returns:
-        Combined DataFrame of all invoice line items.
+        Combined DataFrame of all invoice line items (read back from the CSV).
     """
-    all_data: List[pd.DataFrame] = []
-
     if not os.path.isdir(invoices_folder):
         print(f"[ERROR] Invoices folder not found: {invoices_folder}")
         return pd.DataFrame()
 
     os.makedirs(data_folder, exist_ok=True)
-
-    for file_name in os.listdir(invoices_folder):
-        if file_name.lower().endswith((".pdf", ".jpg", ".jpeg", ".png")):
-            full_path = os.path.join(invoices_folder, file_name)
-            print(f"[INFO] Processing invoice file: {full_path}")
-            df = extract_line_items(full_path)
-
-            if not df.empty:
-                df["invoice_file"] = file_name
-                all_data.append(df)
-            else:
-                print(f"[WARN] No line items extracted for: {file_name}")
-
-    if all_data:
-        df_combined = pd.concat(all_data, ignore_index=True)
-        output_path = os.path.join(data_folder, "extracted_invoices.csv")
-        df_combined.to_csv(output_path, index=False, encoding="utf-8")
+    output_path = os.path.join(data_folder, "extracted_invoices.csv")
+
+    file_names = [
+        file_name for file_name in os.listdir(invoices_folder)
+        if file_name.lower().endswith((".pdf", ".jpg", ".jpeg", ".png"))
+    ]
+
+    semaphore = asyncio.Semaphore(concurrency)
+    csv_file = None  # opened on the first non-empty invoice
+    rows_written = 0
+
+    if file_names:
+        # Rasterizing/decoding is CPU-bound, so spread it over processes
+        # while the Gemini calls overlap on the event loop. Workers only
+        # rasterize, so they warm up the config once and never touch Gemini.
+        max_workers = min(os.cpu_count() or 1, len(file_names))
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_get_config) as pool:
+                tasks = []
+                for file_name in file_names:
+                    full_path = os.path.join(invoices_folder, file_name)
+                    print(f"[INFO] Processing invoice file: {full_path}")
+                    tasks.append(_extract_named(file_name, full_path, semaphore, pool))
+
+                for next_done in asyncio.as_completed(tasks):
+                    file_name, df = await next_done
+
+                    if df.empty:
+                        print(f"[WARN] No line items extracted for: {file_name}")
+                        continue
+
+                    df["invoice_file"] = file_name
+
+                    if csv_file is None:
+                        csv_file = open(output_path, "wb")
+                    write_csv(df, csv_file, include_header=rows_written == 0)
+                    rows_written += len(df)
+        finally:
+            if csv_file is not None:
+                csv_file.close()
+
+    if rows_written:
         print(f"[INFO] Saved extracted invoice data to: {output_path}")
-        return df_combined
+        return pd.read_csv(
+            output_path,
+            dtype=EXTRACTED_DTYPES,
+            keep_default_na=False,
+            na_values=[""],
+        )
     else:
         print("[WARN] No invoices processed successfully. No CSV created.")
         return pd.DataFrame()
+
+
+def process_invoices(invoices_folder: str, data_folder: str) -> pd.DataFrame:
+    """
+    Synchronous entry point for process_invoices_async().
+    """
+    return asyncio.run(process_invoices_async(invoices_folder, data_folder))
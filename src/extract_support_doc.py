@@ -1,60 +1,125 @@
 import google.generativeai as genai
+import asyncio
+import functools
 import json
 from PIL import Image
 import os
 import re
+from typing_extensions import TypedDict
+from src import llm_cache
 
-# Load config
-with open('config/config.json') as f:
-    config = json.load(f)
+# Load config and configure Gemini lazily, on first use
+@functools.lru_cache(maxsize=1)
+def _get_model():
+    with open('config/config.json') as f:
+        config = json.load(f)
 
-# Configure Gemini
-genai.configure(api_key=config['gemini_api_key'])
-model = genai.GenerativeModel("gemini-1.5-flash")
+    genai.configure(api_key=config['gemini_api_key'])
+    return genai.GenerativeModel("gemini-1.5-flash")
+
+# Response schema: Gemini returns strict JSON like {"non_vat": 1234.56}
+class NonVatValue(TypedDict):
+    non_vat: float
+
+NON_VAT_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=NonVatValue,
+)
+
+# Fallback parsing of non-JSON replies: code fences, then the first number
+_FENCE_RE = re.compile(r"```.*?```", re.DOTALL)
+_NUM_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+
+SUPPORT_DOC_PROMPT = """
+You are a financial data extraction engine.
+
+From this document, extract ONLY the total non-VAT value
+(the pre-tax total) as "non_vat".
+- Numeric value only
+- No currency symbol
+- No commas
+
+Example output: {"non_vat": 1234.56}
+"""
+
+def _parse_non_vat_value(raw_text):
+    """
+    Reads "non_vat" from Gemini's JSON reply, falling back to the first
+    number in the text if the reply is not the expected JSON.
+    Returns a float or None if no number was found.
+    """
+    raw_text = raw_text.strip()
+
+    try:
+        data = json.loads(raw_text)
+        if isinstance(data, dict) and isinstance(data.get("non_vat"), (int, float)):
+            return float(data["non_vat"])
+    except json.JSONDecodeError:
+        pass
+
+    # Remove backticks or "json" code fences if Gemini adds them
+    raw_text = _FENCE_RE.sub("", raw_text).strip()
+
+    # Extract the first numeric value (integer or float)
+    match = _NUM_RE.search(raw_text)
+    if match:
+        return float(match.group())
+
+    print(f"[WARN] No numeric value found in: {raw_text}")
+    return None
 
 def extract_value_from_support_doc(doc_path):
     """
     Extracts ONLY the non-VAT total value (pre-tax amount)
     from a supporting document using Gemini vision model.
     Returns a float or None if failed.
+    Results are cached by file content, so unchanged documents skip Gemini.
     """
     try:
+        cache_key = llm_cache.file_key(doc_path, "nonvat")
+        value = llm_cache.get(cache_key)
+        if value is not None:
+            print(f"[INFO] Using cached non-VAT value for: {doc_path}")
+            return value
+
         # Load image
         img = Image.open(doc_path)
 
-        # Stronger prompt to force numeric-only output
-        prompt = """
-        You are a financial data extraction engine.
-
-        From this document, extract ONLY the total non-VAT value
-        (the pre-tax total). 
-        Return:
-        - ONLY the numeric value
-        - No currency symbol
-        - No explanation
-        - No text
-        - No commas
-        - No quotes
-        - No code blocks
-
-        Example output: 1234.56
-        """
-
-        response = model.generate_content([prompt, img])
+        response = _get_model().generate_content([SUPPORT_DOC_PROMPT, img],
+                                                 generation_config=NON_VAT_CONFIG)
+        value = _parse_non_vat_value(response.text)
+        if value is not None:
+            llm_cache.put(cache_key, value)
+        return value
 
-        raw_text = response.text.strip()
+    except Exception as e:
+        print(f"[ERROR] Failed to extract from {doc_path}: {e}")
+        return None
 
-        # Remove backticks or "json" code fences if Gemini adds them
-        raw_text = re.sub(r"```.*?```", "", raw_text, flags=re.DOTALL).strip()
+async def extract_value_from_support_doc_async(doc_path, semaphore):
+    """
+    Async version of extract_value_from_support_doc().
+    The semaphore caps how many Gemini requests are in flight at once.
+    """
+    async with semaphore:
+        try:
+            cache_key = llm_cache.file_key(doc_path, "nonvat")
+            value = llm_cache.get(cache_key)
+            if value is not None:
+                print(f"[INFO] Using cached non-VAT value for: {doc_path}")
+                return value
 
-        # Extract the first numeric value (integer or float)
-        match = re.search(r"[-+]?\d*\.\d+|\d+", raw_text)
-        if match:
-            return float(match.group())
+            img = await asyncio.to_thread(Image.open, doc_path)
 
-        print(f"[WARN] No numeric value found in: {raw_text}")
-        return None
+            response = await _get_model().generate_content_async(
+                [SUPPORT_DOC_PROMPT, img],
+                generation_config=NON_VAT_CONFIG,
+            )
+            value = _parse_non_vat_value(response.text)
+            if value is not None:
+                llm_cache.put(cache_key, value)
+            return value
 
-    except Exception as e:
-        print(f"[ERROR] Failed to extract from {doc_path}: {e}")
-        return None
+        except Exception as e:
+            print(f"[ERROR] Failed to extract from {doc_path}: {e}")
+            return None
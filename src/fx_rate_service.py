@@ -2,6 +2,10 @@ import pandas as pd
 import os
 import requests
 import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from src.csv_writer import write_csv
 
 # ---- Load config ----
 with open('config/config.json', 'r', encoding='utf-8') as f:
@@ -10,6 +14,19 @@ with open('config/config.json', 'r', encoding='utf-8') as f:
 base_currency = config.get('base_currency', 'USD')
 rates_file = config.get('rates_file', 'data/fx_rates.csv')
 
+# ---- Shared HTTP session (keep-alive + retries) for FX API calls ----
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    max_retries=Retry(total=3,
+                      backoff_factor=0.3,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      raise_on_status=False),
+)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
 
 # ---- Load local FX rates ----
 def load_rates(path: str | None = None) -> dict:
@@ -34,10 +51,10 @@ def load_rates(path: str | None = None) -> dict:
             print(f"[WARN] FX rates file missing required columns in: {path}")
             return {}
 
-        rates_dict = {
-            (str(row["from_currency"]).upper(), str(row["to_currency"]).upper()): float(row["rate"])
-            for _, row in df_rates.iterrows()
-        }
+        from_codes = df_rates["from_currency"].astype(str).str.upper()
+        to_codes = df_rates["to_currency"].astype(str).str.upper()
+        rates = df_rates["rate"].astype(float)
+        rates_dict = dict(zip(zip(from_codes, to_codes), rates))
         print(f"[INFO] Loaded {len(rates_dict)} FX rates from: {path}")
         return rates_dict
 
@@ -55,6 +72,7 @@ def get_rate(from_currency: str,
     Get FX rate from from_currency to to_currency.
 
     Priority:
+    0) Same currency -> 1.0
     1) Local rates_dict
     2) External API (cached per from_currency)
     3) Fallback 1.0 on error
@@ -69,7 +87,12 @@ def get_rate(from_currency: str,
     from_currency = from_currency.upper()
     to_currency = to_currency.upper()
     rates_dict = rates_dict or {}
-    api_cache = api_cache or {}
+    # Only replace a missing cache: an empty dict passed in must be filled in place
+    if api_cache is None:
+        api_cache = {}
+
+    if from_currency == to_currency:
+        return 1.0
 
     # 1) Local file rate
     if (from_currency, to_currency) in rates_dict:
@@ -79,7 +102,7 @@ def get_rate(from_currency: str,
     try:
         if from_currency not in api_cache:
             url = f"https://api.exchangerate-api.com/v4/latest/{from_currency}"
-            resp = requests.get(url, timeout=5)
+            resp = _session.get(url, timeout=5)
             if resp.ok:
                 api_cache[from_currency] = resp.json().get("rates", {})
             else:
@@ -99,14 +122,6 @@ def get_rate(from_currency: str,
         return 1.0
 
 
-# ---- Helper: safe float ----
-def _safe_float(val):
-    try:
-        return float(val)
-    except (TypeError, ValueError):
-        return None
-
-
 # ---- Apply FX to invoice DataFrame ----
 def apply_fx_rates(df_invoice: pd.DataFrame, data_folder: str) -> pd.DataFrame:
     """
@@ -116,6 +131,7 @@ def apply_fx_rates(df_invoice: pd.DataFrame, data_folder: str) -> pd.DataFrame:
     - Uses local CSV rates if available.
     - Falls back to online API if needed.
     - Falls back to 1.0 if everything fails.
+    - Rows with a missing currency are kept as-is (treated as base_currency).
 
     Saves result to converted_invoices.csv in data_folder.
     """
@@ -124,29 +140,29 @@ def apply_fx_rates(df_invoice: pd.DataFrame, data_folder: str) -> pd.DataFrame:
     rates_dict = load_rates()
     api_cache = {}
 
-    def _convert_row(row):
-        currency = row.get("currency")
-        amount = _safe_float(row.get("total_non_vat_value"))
+    df_invoice = df_invoice.copy()
 
-        if amount is None:
-            print(f"[WARN] Cannot convert non-numeric amount: {row.get('total_non_vat_value')}")
-            return None
+    amounts = pd.to_numeric(df_invoice["total_non_vat_value"], errors="coerce")
+    currencies = df_invoice["currency"].str.upper()
 
-        if not currency:
-            print(f"[WARN] Missing currency for row, using base currency ({base_currency}) as-is.")
-            return amount
+    n_bad_amounts = int(amounts.isna().sum())
+    if n_bad_amounts:
+        print(f"[WARN] Cannot convert {n_bad_amounts} row(s) with a non-numeric amount")
 
-        if currency.upper() == base_currency.upper():
-            return amount
+    n_missing_currency = int(currencies.isna().sum())
+    if n_missing_currency:
+        print(f"[WARN] Missing currency for {n_missing_currency} row(s), "
+              f"using base currency ({base_currency}) as-is.")
 
-        rate = get_rate(currency, base_currency, rates_dict, api_cache)
-        return amount * rate
+    # Pass 1: resolve each unique currency once (at most one API call per currency)
+    unique_currs = currencies.dropna().unique()
+    rate_map = {cur: get_rate(cur, base_currency, rates_dict, api_cache) for cur in unique_currs}
 
-    df_invoice = df_invoice.copy()
-    df_invoice["converted_non_vat_value"] = df_invoice.apply(_convert_row, axis=1)
+    # Pass 2: single vectorized multiply
+    df_invoice["converted_non_vat_value"] = amounts * currencies.map(rate_map).fillna(1.0)
 
     output_path = os.path.join(data_folder, "converted_invoices.csv")
-    df_invoice.to_csv(output_path, index=False, encoding="utf-8")
+    write_csv(df_invoice, output_path)
     print(f"[INFO] Saved FX-converted invoices to: {output_path}")
 
     return df_invoice
@@ -0,0 +1,68 @@
+import os
+import json
+import hashlib
+import sqlite3
+from contextlib import closing
+from typing import Any
+
+# ---- Load config ----
+with open('config/config.json', 'r', encoding='utf-8') as f:
+    config = json.load(f)
+
+cache_file = config.get('llm_cache_file', 'data/llm_cache.db')
+
+
+# ---- Helper: open the cache DB (creating the table on first use) ----
+def _connect(path: str | None = None) -> sqlite3.Connection:
+    path = path or cache_file
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+    )
+    return conn
+
+
+# ---- Cache key: content hash of the file + what was extracted ----
+def file_key(path: str, suffix: str) -> str:
+    """
+    Build a cache key from the SHA-256 of the file bytes, e.g. '<sha256>:lineitems'.
+    Renaming or moving a file keeps its key; changing its bytes invalidates it.
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return f"{sha.hexdigest()}:{suffix}"
+
+
+def get(key: str) -> Any:
+    """
+    Return the cached JSON value for key, or None if not cached / unreadable.
+    """
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    except (sqlite3.Error, json.JSONDecodeError) as e:
+        print(f"[WARN] LLM cache read failed for {key}: {e}")
+        return None
+
+
+def put(key: str, value: Any) -> None:
+    """
+    Store a JSON-serialisable value under key (overwrites any previous value).
+    """
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
+
+    except sqlite3.Error as e:
+        print(f"[WARN] LLM cache write failed for {key}: {e}")
@@ -1,7 +1,8 @@
 import pandas as pd
 import os
 import json
-from src.extract_support_doc import extract_value_from_support_doc
+import asyncio
+from src.extract_support_doc import extract_value_from_support_doc_async
 
 # Load config
 with open('config/config.json', 'r', encoding='utf-8') as f:
@@ -9,6 +10,9 @@ with open('config/config.json', 'r', encoding='utf-8') as f:
 
 tolerance = config.get('tolerance', 0.01)  # default fallback
 
+# Max number of supporting-doc Gemini requests in flight at once
+GEMINI_CONCURRENCY = 20
+
 def _normalize_for_match(text: str) -> str:
     """
     Normalize text for simple filename matching:
@@ -20,6 +24,16 @@ def _normalize_for_match(text: str) -> str:
         return ""
     return text.strip().lower().replace(" ", "_")
 
+async def _extract_values_async(doc_paths: list[str]) -> list:
+    """
+    Extracts the non-VAT value from every doc in doc_paths concurrently.
+    Results are returned in the same order as doc_paths.
+    """
+    semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+    return await asyncio.gather(
+        *[extract_value_from_support_doc_async(p, semaphore) for p in doc_paths]
+    )
+
 def match_and_verify(df_invoice: pd.DataFrame,
                      supporting_docs_folder: str,
                      data_folder: str) -> pd.DataFrame:
@@ -27,7 +41,8 @@ def match_and_verify(df_invoice: pd.DataFrame,
     For each invoice line item:
     - Try to find a supporting document whose filename contains a normalized
       version of the item_description.
-    - Extract the non-VAT value from the supporting document using Gemini.
+    - Extract the non-VAT value from the supporting documents using Gemini
+      (all matched documents are sent concurrently).
     - Compare it with the invoice total_non_vat_value using the configured tolerance.
     - Save verification results as CSV in data_folder.
 
@@ -36,12 +51,22 @@ def match_and_verify(df_invoice: pd.DataFrame,
     """
 
     # Ensure folders exist / are valid
-    if not os.path.isdir(supporting_docs_folder):
+    docs_folder_ok = os.path.isdir(supporting_docs_folder)
+    if not docs_folder_ok:
         print(f"[WARN] Supporting docs folder does not exist: {supporting_docs_folder}")
 
     os.makedirs(data_folder, exist_ok=True)
 
+    # List the folder once and lowercase names once, instead of per row
+    docs_lower = []
+    if docs_folder_ok:
+        docs_lower = [(doc, doc.lower()) for doc in os.listdir(supporting_docs_folder)]
+
+    # target_key -> first matching filename ("" if none); repeated items are looked up once
+    match_cache: dict[str, str] = {}
+
     verified_rows = []
+    pending = []  # (index into verified_rows, doc_path) awaiting Gemini extraction
 
     for idx, row in df_invoice.iterrows():
         item_desc = row.get('item_description', '')
@@ -51,10 +76,7 @@ def match_and_verify(df_invoice: pd.DataFrame,
         target_key = _normalize_for_match(item_desc)
 
         supporting_found = False
-        matching_value = False
         matched_doc = ""
-        extracted_value = None
-        diff = None
 
         # Guard against missing numeric value
         try:
@@ -63,21 +85,17 @@ def match_and_verify(df_invoice: pd.DataFrame,
             print(f"[WARN] Non-numeric non-VAT value in invoice row {idx}: {non_vat_value}")
             non_vat_value = None
 
-        if os.path.isdir(supporting_docs_folder) and target_key:
-            for doc in os.listdir(supporting_docs_folder):
-                doc_lower = doc.lower()
-                if target_key in doc_lower:
-                    supporting_found = True
-                    matched_doc = doc
-                    doc_path = os.path.join(supporting_docs_folder, doc)
-
-                    extracted_value = extract_value_from_support_doc(doc_path)
-
-                    if extracted_value is not None and non_vat_value is not None:
-                        diff = extracted_value - non_vat_value
-                        if abs(diff) <= tolerance:
-                            matching_value = True
-                    break  # stop after first match
+        if docs_folder_ok and target_key:
+            if target_key not in match_cache:
+                # first filename containing the key, as before
+                match_cache[target_key] = next(
+                    (doc for doc, doc_lower in docs_lower if target_key in doc_lower), ""
+                )
+
+            matched_doc = match_cache[target_key]
+            if matched_doc:
+                supporting_found = True
+                pending.append((len(verified_rows), os.path.join(supporting_docs_folder, matched_doc)))
         else:
             if not target_key:
                 print(f"[WARN] Empty or invalid item_description in row {idx}")
@@ -87,12 +105,28 @@ def match_and_verify(df_invoice: pd.DataFrame,
             "invoice_non_vat_value": non_vat_value,
             "supporting_attached": supporting_found,
             "supporting_file": matched_doc,
-            "extracted_non_vat_value": extracted_value,
-            "difference": diff,
-            "non_vat_match": matching_value,
+            "extracted_non_vat_value": None,
+            "difference": None,
+            "non_vat_match": False,
             "invoice_file": row.get("invoice_file", "")
         })
 
+    # Extract values from all matched documents concurrently (each document once)
+    if pending:
+        doc_paths = list(dict.fromkeys(doc_path for _, doc_path in pending))
+        values_by_doc = dict(zip(doc_paths, asyncio.run(_extract_values_async(doc_paths))))
+
+        for row_pos, doc_path in pending:
+            extracted_value = values_by_doc[doc_path]
+            result = verified_rows[row_pos]
+            result["extracted_non_vat_value"] = extracted_value
+
+            non_vat_value = result["invoice_non_vat_value"]
+            if extracted_value is not None and non_vat_value is not None:
+                diff = extracted_value - non_vat_value
+                result["difference"] = diff
+                result["non_vat_match"] = abs(diff) <= tolerance
+
     df_verification = pd.DataFrame(verified_rows)
 
     output_path = os.path.join(data_folder, "verification_results.csv")
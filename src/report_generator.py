@@ -1,6 +1,23 @@
 import pandas as pd
 import os
-from openpyxl.utils import get_column_letter
+
+def _column_widths(df: pd.DataFrame) -> list[int]:
+    """
+    Returns a width per column (header included, capped at 60), computed
+    from the DataFrame so the written sheet is not re-scanned cell by cell.
+    """
+    widths = []
+    for col in df.columns:
+        values = df[col]
+        # Empty cells count as 0, like blank cells in the sheet
+        lengths = values.astype(str).str.len().where(values.notna(), 0)
+        longest = max(len(str(col)), int(lengths.max()) if len(values) else 0)
+        widths.append(min(60, longest + 2))
+    return widths
+
+def _autosize_columns(sheet, df: pd.DataFrame) -> None:
+    for i, width in enumerate(_column_widths(df)):
+        sheet.set_column(i, i, width)
 
 def generate_report(df_invoice: pd.DataFrame,
                     df_verification: pd.DataFrame,
@@ -15,25 +32,20 @@ def generate_report(df_invoice: pd.DataFrame,
     # Ensure output folder exists
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    # Create Excel writer
-    with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
+    # Create Excel writer (xlsxwriter writes files faster than openpyxl).
+    # Not using constant_memory: pandas writes cells column by column, and
+    # xlsxwriter drops out-of-order rows in that mode.
+    with pd.ExcelWriter(output_path, engine='xlsxwriter') as writer:
 
         # 1️⃣ Write the invoice extraction sheet
         df_invoice.to_excel(writer, sheet_name="Extracted Line Items", index=False)
 
         # Auto-size columns
-        sheet = writer.sheets["Extracted Line Items"]
-        for column_cells in sheet.columns:
-            length = max(len(str(cell.value)) if cell.value is not None else 0 for cell in column_cells)
-            sheet.column_dimensions[get_column_letter(column_cells[0].column)].width = min(60, length + 2)
+        _autosize_columns(writer.sheets["Extracted Line Items"], df_invoice)
 
         # 2️⃣ Write the verification sheet
         df_verification.to_excel(writer, sheet_name="Verification Results", index=False)
-
-        sheet = writer.sheets["Verification Results"]
-        for column_cells in sheet.columns:
-            length = max(len(str(cell.value)) if cell.value is not None else 0 for cell in column_cells)
-            sheet.column_dimensions[get_column_letter(column_cells[0].column)].width = min(60, length + 2)
+        _autosize_columns(writer.sheets["Verification Results"], df_verification)
 
         # 3️⃣ Build a summary sheet
         summary_data = {
@@ -47,10 +59,6 @@ def generate_report(df_invoice: pd.DataFrame,
 
         df_summary = pd.DataFrame([summary_data])
         df_summary.to_excel(writer, sheet_name="Summary", index=False)
-
-        sheet = writer.sheets["Summary"]
-        for column_cells in sheet.columns:
-            length = max(len(str(cell.value)) if cell.value is not None else 0 for cell in column_cells)
-            sheet.column_dimensions[get_column_letter(column_cells[0].column)].width = min(60, length + 2)
+        _autosize_columns(writer.sheets["Summary"], df_summary)
 
     print(f"[INFO] Excel validation report saved to: {output_path}")
@@ -1,7 +1,9 @@
 import os
+import asyncio
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
-from src.extract_invoice import process_invoices
+from src.extract_invoice import process_invoices_async
 from src.matcher import match_and_verify
 from src.fx_rate_service import apply_fx_rates
 
@@ -21,6 +23,8 @@ def run_validation(invoices_folder: str,
     3) Apply FX rates and add converted_non_vat_value column
        -> saves converted_invoices.csv in data_folder
 
+    Steps 2 and 3 are independent and run concurrently.
+
     Returns:
         df_invoice (pd.DataFrame): invoice lines with FX conversion
         df_verification (pd.DataFrame): per-line verification results
@@ -38,19 +42,23 @@ def run_validation(invoices_folder: str,
 
     # 1) Extract invoice line items
     print("[INFO] Step 1/3: Extracting invoice line items...")
-    df_invoice = process_invoices(invoices_folder, data_folder)
+    df_invoice = asyncio.run(process_invoices_async(invoices_folder, data_folder))
 
     if df_invoice.empty:
         print("[WARN] No invoice data extracted. Stopping pipeline.")
         return pd.DataFrame(), pd.DataFrame()
 
-    # 2) Match & verify with supporting docs
-    print("[INFO] Step 2/3: Matching and verifying against supporting documents...")
-    df_verification = match_and_verify(df_invoice, supporting_docs_folder, data_folder)
+    # 2) + 3) only depend on df_invoice, so run them side by side:
+    # Gemini-bound verification overlaps with the FX lookups
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        print("[INFO] Step 2/3: Matching and verifying against supporting documents...")
+        f_verification = executor.submit(match_and_verify, df_invoice, supporting_docs_folder, data_folder)
+
+        print("[INFO] Step 3/3: Applying FX rates...")
+        f_fx = executor.submit(apply_fx_rates, df_invoice, data_folder)
 
-    # 3) Apply FX rates
-    print("[INFO] Step 3/3: Applying FX rates...")
-    df_invoice_fx = apply_fx_rates(df_invoice, data_folder)
+        df_verification = f_verification.result()
+        df_invoice_fx = f_fx.result()
 
     print("[INFO] Validation pipeline completed.")
     return df_invoice_fx, df_verification